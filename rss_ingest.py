@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 簡素版 RSS 逐次クローラ:
- Wikipedia クローラと同じ思想で「1秒1リクエスト (GET/POST 共通)」の RateLimiter を共有。
- 並列なし・重複送信許容・加工処理最小。
+ Wikipedia クローラと同じ思想の RateLimiter をホスト単位で共有。
+ feed 処理は Semaphore で上限付き並列・重複送信許容・加工処理最小。
 
 環境変数:
     ADD_ENDPOINT      (default: https://dev.371tti.net/api/index)
@@ -10,16 +10,28 @@
     FETCH_INTERVAL    (全フィード1周後スリープ秒, default 600)
     MAX_ENTRIES_PER_FEED (各feedの先頭N件, default 5)
     SUMMARY_MAX       (要約最大長, default 400)
+    CONCURRENCY       (同時処理feed数, default 8)
+    BURST             (トークンバケット容量, default 5)
+    INTERNAL_REQ_INTERVAL (内部API POST間隔秒, default 0.02)
+    FEED_STATE_PATH   (ETag/Last-Modified 永続化先, default feed_state.json)
+    SEEN_CAP          (送信済みリンク LRU 上限, default 50000)
 
 依存:
-    pip install aiohttp feedparser
+    pip install "httpx[http2]" lxml
 """
 from __future__ import annotations
 import os
+import json
 import asyncio
-from typing import List, Dict, Any, Optional
-import aiohttp
-import feedparser
+import hashlib
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import urllib.parse
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, NamedTuple, Tuple
+import httpx
+from lxml import etree
 
 # Windows 対策が必要ならここで追加 (簡素版では省略)
 
@@ -28,8 +40,31 @@ REQ_INTERVAL = float(os.getenv("REQ_INTERVAL", "0.1"))
 FETCH_INTERVAL = float(os.getenv("FETCH_INTERVAL", "600"))
 MAX_ENTRIES_PER_FEED = int(os.getenv("MAX_ENTRIES_PER_FEED", "8"))
 SUMMARY_MAX = int(os.getenv("SUMMARY_MAX", "400"))
+CONCURRENCY = int(os.getenv("CONCURRENCY", "8"))
+BURST = int(os.getenv("BURST", "5"))
+POST_INFLIGHT = int(os.getenv("POST_INFLIGHT", "16"))
+SEEN_CAP = int(os.getenv("SEEN_CAP", "50000"))
+INTERNAL_REQ_INTERVAL = float(os.getenv("INTERNAL_REQ_INTERVAL", "0.02"))
+FEED_STATE_PATH = os.getenv("FEED_STATE_PATH", "feed_state.json")
 USER_AGENT = "RssIngestSimple/0.1 (+https://example.com)"
 
+logger = logging.getLogger("rss_ingest")
+
+def setup_logging() -> QueueListener:
+    """stdout への書き込みをバックグラウンドスレッドに逃がす。
+
+    print はイベントループ上で stdout ロック + 行毎 flush の同期点になるため、
+    QueueHandler 経由で QueueListener のスレッドに I/O を任せる。
+    """
+    log_queue: queue.Queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
 # --- フィード定義 (最低限: name, url, icon(optional)) ---
 FEEDS: List[Dict[str, Any]] = [
     # （必要に応じて減らすと負荷確認が容易）
@@ -112,88 +147,249 @@ FEEDS: List[Dict[str, Any]] = [
 ]
 
 class RateLimiter:
-    def __init__(self, interval: float):
+    """トークンバケット方式: 長期レート 1/interval req/s を維持しつつ
+    burst 個までのバーストを許容する (固定間隔ゲートだと N 件連続 POST が
+    N*interval かかるのに対し、バケット分は即時に流れる)。"""
+    def __init__(self, interval: float, burst: int = 1):
         self.interval = interval
-        self._last = 0.0
+        self.rate = (1.0 / interval) if interval > 0 else 0.0
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._last_refill = 0.0
         self._lock = asyncio.Lock()
+        self._loop = None  # 初回 wait 時に実行中 loop をキャッシュ
     async def wait(self):
-        async with self._lock:
-            now = asyncio.get_event_loop().time()
-            sleep_for = self.interval - (now - self._last)
-            if sleep_for > 0:
-                await asyncio.sleep(sleep_for)
-            self._last = asyncio.get_event_loop().time()
+        if self.rate <= 0:
+            return
+        # ロック中はトークン計算のみ、sleep はロック解放後に行う
+        # (sleep をロック内で await すると他の待機者まで直列化されてしまう)
+        loop = self._loop
+        if loop is None:
+            loop = self._loop = asyncio.get_running_loop()
+        while True:
+            async with self._lock:
+                now = loop.time()
+                if self._last_refill:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                sleep_for = (1.0 - self._tokens) / self.rate
+            await asyncio.sleep(sleep_for)
+
+# 内部 API への書き込みは外部クロールの礼儀間隔とは別枠で制限する
+# (ローカル endpoint を Wikipedia 並みに絞る必要はない)
+internal_limiter = RateLimiter(INTERNAL_REQ_INTERVAL, BURST)
+
+# ホスト単位の RateLimiter (同一ホストへの礼儀は維持しつつ別ホストは並列化)
+_rate_limiters: Dict[str, RateLimiter] = {}
+
+def rate_limiter_for(url: str) -> RateLimiter:
+    host = urllib.parse.urlsplit(url).netloc
+    limiter = _rate_limiters.get(host)
+    if limiter is None:
+        limiter = _rate_limiters[host] = RateLimiter(REQ_INTERVAL, BURST)
+    return limiter
 
-rate_limiter = RateLimiter(REQ_INTERVAL)
+# 送信済みリンクの LRU (8byte ハッシュキーなので上限時でも ~400KB)
+# ETag スキップをすり抜けた再掲エントリの再 POST を抑える
+_seen: OrderedDict = OrderedDict()
+
+def _seen_key(link: str) -> bytes:
+    return hashlib.blake2b(link.encode('utf-8'), digest_size=8).digest()
+
+# --- 条件付き GET 用の feed 状態 (url -> [etag, last_modified]) ---
+FEED_STATE: Dict[str, List[Optional[str]]] = {}
+
+def load_feed_state():
+    try:
+        with open(FEED_STATE_PATH, "r", encoding="utf-8") as f:
+            FEED_STATE.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logger.warning(f"[WARN] feed state load: {e}")
+
+def save_feed_state():
+    try:
+        with open(FEED_STATE_PATH, "w", encoding="utf-8") as f:
+            json.dump(FEED_STATE, f, ensure_ascii=False)
+    except Exception as e:
+        logger.warning(f"[WARN] feed state save: {e}")
+
+# --- 解析 ---
+class Parsed(NamedTuple):
+    """エントリ毎の dict を作らず 3 本の平行リストで持つ (index が対応)。"""
+    titles: List[str]
+    links: List[str]
+    summaries: List[str]
+
+def _extract_entry(elem) -> Tuple[str, str, str]:
+    """item/entry 要素から使用フィールド (title, link, summary) のみを取り出す。
+
+    feedparser は相対URL解決や HTML サニタイズで大半の時間を使うが、
+    ここでは 3 フィールドしか使わない (RSS2/RDF/Atom 対応)。
+    """
+    findtext = elem.findtext  # エントリ毎に最大5回呼ぶので属性参照を1回に
+    title = (findtext('{*}title') or '').strip()
+    link = ''
+    for le in elem.iterfind('{*}link'):
+        href = (le.text or '').strip() or (le.get('href') or '').strip()
+        if href and le.get('rel') in (None, 'alternate'):
+            link = href
+            break
+    if SUMMARY_MAX <= 0:
+        return title, link, ''
+    summary = (findtext('{*}description')
+               or findtext('{*}summary')
+               or findtext('{*}encoded')
+               or findtext('{*}content')
+               or '')
+    # 全文を持ち回らず抽出時点で切り詰める (summary 列のメモリを N*SUMMARY_MAX に固定)
+    return title, link, summary[:SUMMARY_MAX].strip()
 
 # --- HTTP ---
-async def fetch_feed(session: aiohttp.ClientSession, feed: Dict[str, Any]) -> Optional[feedparser.FeedParserDict]:
-    await rate_limiter.wait()
+async def fetch_feed(session: httpx.AsyncClient, feed: Dict[str, Any]) -> Optional[Parsed]:
+    """feed をストリーミング取得し、チャンク到着ごとに逐次解析する。
+
+    全文を read() で溜め込まず、MAX_ENTRIES_PER_FEED 件に達した時点で
+    ダウンロード自体を打ち切る (巨大feedの帯域・ピークメモリ節約)。
+    """
+    await rate_limiter_for(feed['url']).wait()
+    # 前回の ETag / Last-Modified があれば条件付き GET (未更新なら 304 で即終了)
+    headers = {}
+    state = FEED_STATE.get(feed['url'])
+    if state:
+        etag, last_modified = state
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    parsed = Parsed([], [], [])
     try:
-        async with session.get(feed['url'], timeout=30, headers={"User-Agent": USER_AGENT}) as resp:
-            if resp.status != 200:
-                print(f"[WARN] {feed['name']} status={resp.status}")
+        async with session.stream("GET", feed['url'], timeout=30, headers=headers) as resp:
+            if resp.status_code == 304:
+                logger.info(f"[SKIP] {feed['name']} not modified")
                 return None
-            raw = await resp.read()
+            if resp.status_code != 200:
+                logger.warning(f"[WARN] {feed['name']} status={resp.status_code}")
+                return None
+            # 検証子は取得成功が確定するまで保存しない (途中で切れた fetch の
+            # 分まで記録すると、次周回以降 304 で未処理のエントリを取りこぼす)
+            etag = resp.headers.get('ETag')
+            last_modified = resp.headers.get('Last-Modified')
+            parser = etree.XMLPullParser(events=('end',), recover=True, huge_tree=False)
+            async for chunk in resp.aiter_bytes(65536):
+                parser.feed(chunk)
+                for _, elem in parser.read_events():
+                    tag = elem.tag
+                    if not isinstance(tag, str) or tag.rpartition('}')[2] not in ('item', 'entry'):
+                        continue
+                    title, link, summary = _extract_entry(elem)
+                    parsed.titles.append(title)
+                    parsed.links.append(link)
+                    parsed.summaries.append(summary)
+                    # 解析済み要素と先行兄弟を解放しメモリを一定に保つ
+                    elem.clear()
+                    while elem.getprevious() is not None:
+                        del elem.getparent()[0]
+                    if len(parsed.links) >= MAX_ENTRIES_PER_FEED:
+                        if etag or last_modified:
+                            FEED_STATE[feed['url']] = [etag, last_modified]
+                        return parsed
     except Exception as e:
-        print(f"[ERR] fetch {feed['name']}: {e}")
+        logger.error(f"[ERR] fetch {feed['name']}: {e}")
         return None
-    return feedparser.parse(raw)
+    if etag or last_modified:
+        FEED_STATE[feed['url']] = [etag, last_modified]
+    return parsed
 DEFAULT_TAGS = ["news"]  # feed に tags が無い場合のみ使用
 
-async def post_entry(session: aiohttp.ClientSession, feed: Dict[str, Any], entry: feedparser.FeedParserDict):
-    # GET と POST 共通で 1 秒間隔
-    title = (entry.get('title') or '').strip()
-    link = (entry.get('link') or '').strip()
+# 起動時に一度だけ正規化しておき、エントリ毎の `feed.get('tags') or DEFAULT_TAGS` を不要にする
+for _feed in FEEDS:
+    _feed['tags'] = list(_feed.get('tags') or DEFAULT_TAGS)
+del _feed
+
+async def post_entry(session: httpx.AsyncClient, feed: Dict[str, Any], title: str, link: str, summary: str):
     if not link:
         return
-    summary = ''
-    # summary / content
-    if 'summary' in entry:
-        summary = entry.summary
-    elif 'content' in entry:
-        try:
-            summary = entry.content[0].value
-        except Exception:
-            pass
-    summary = summary.strip()
+    key = _seen_key(link)
+    if key in _seen:
+        _seen.move_to_end(key)
+        return
     if not title:
         title = link
-    summary_proc = (summary or '')[:SUMMARY_MAX]
-    tags = feed.get('tags') or DEFAULT_TAGS
-    payload = {"url": link, "title": None, "favicon": None, "tags": tags, "descriptions": summary_proc}
-    await rate_limiter.wait()
+    # summary は抽出時点で SUMMARY_MAX に切り詰め済み
+    payload = {"url": link, "title": None, "favicon": None, "tags": feed['tags'], "descriptions": summary}
+    await internal_limiter.wait()
     try:
-        async with session.post(ADD_ENDPOINT, json=payload, timeout=30, headers={"User-Agent": USER_AGENT}) as resp:
-            if resp.status >= 300:
-                txt = (await resp.text())[:60]
-                print(f"[WARN] add {resp.status} {title[:38]} {txt}")
-            else:
-                print(f"[OK] {feed['name']} :: {title[:60]}")
+        resp = await session.post(ADD_ENDPOINT, json=payload, timeout=30)
+        if resp.status_code >= 300:
+            txt = resp.text[:60]
+            logger.warning(f"[WARN] add {resp.status_code} {title[:38]} {txt}")
+        else:
+            # 成功時のみ既送信に登録 (失敗分は次周回で再送される)
+            _seen[key] = None
+            if len(_seen) > SEEN_CAP:
+                _seen.popitem(last=False)
+            logger.info(f"[OK] {feed['name']} :: {title[:60]}")
     except Exception as e:
-        print(f"[ERR] post {title[:38]} {e}")
+        logger.error(f"[ERR] post {title[:38]} {e}")
 
-async def process_feed(session: aiohttp.ClientSession, feed: Dict[str, Any]):
-    parsed = await fetch_feed(session, feed)
-    if not parsed:
-        return
-    for e in parsed.entries[:MAX_ENTRIES_PER_FEED]:
-        await post_entry(session, feed, e)
+async def post_batch(session: httpx.AsyncClient, feed: Dict[str, Any], parsed: Parsed):
+    """feed 内のエントリをまとめて並行送信する。
+
+    内部 API (/add) は 1 件/リクエストのため、1 POST には畳めないが、
+    逐次 await をやめて POST_INFLIGHT 件ずつ gather で流す
+    (レートは internal_limiter が制御)。
+    """
+    n = len(parsed.links)
+    for start in range(0, n, POST_INFLIGHT):
+        idx = range(start, min(start + POST_INFLIGHT, n))
+        await asyncio.gather(*(
+            post_entry(session, feed, parsed.titles[i], parsed.links[i], parsed.summaries[i])
+            for i in idx
+        ))
+
+async def process_feed(session: httpx.AsyncClient, feed: Dict[str, Any], sem: asyncio.Semaphore):
+    async with sem:
+        parsed = await fetch_feed(session, feed)
+        if not parsed or not parsed.links:
+            return
+        await post_batch(session, feed, parsed)
 
 async def main_loop():
-    print(f"[INFO] start rss simple crawler 1req/{REQ_INTERVAL:.1f}s feeds={len(FEEDS)}")
-    async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as session:
+    logger.info(f"[INFO] start rss simple crawler 1req/{REQ_INTERVAL:.1f}s feeds={len(FEEDS)} concurrency={CONCURRENCY}")
+    sem = asyncio.Semaphore(CONCURRENCY)
+    load_feed_state()
+    # HTTP/2 + keep-alive で同一オリジンへの連続リクエストを 1 コネクションに多重化
+    async with httpx.AsyncClient(
+        http2=True,
+        headers={"User-Agent": USER_AGENT},
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        follow_redirects=True,
+    ) as session:
         loop = 0
         while True:
             loop += 1
-            print(f"[LOOP {loop}] begin")
-            for feed in FEEDS:
-                await process_feed(session, feed)
-            print(f"[SLEEP] {FETCH_INTERVAL}s")
+            logger.info(f"[LOOP {loop}] begin")
+            results = await asyncio.gather(
+                *(process_feed(session, feed, sem) for feed in FEEDS),
+                return_exceptions=True,
+            )
+            for feed, r in zip(FEEDS, results):
+                if isinstance(r, Exception):
+                    logger.error(f"[ERR] feed {feed['name']}: {r}")
+            save_feed_state()
+            logger.info(f"[SLEEP] {FETCH_INTERVAL}s")
             await asyncio.sleep(FETCH_INTERVAL)
 
 if __name__ == '__main__':
+    listener = setup_logging()
     try:
         asyncio.run(main_loop())
     except KeyboardInterrupt:
-        print("\n[INFO] stopped")
+        logger.info("[INFO] stopped")
+    finally:
+        listener.stop()
@@ -6,17 +6,17 @@
 
 import os
 import random
+import logging
+import queue
 import urllib.parse
 import asyncio
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime, timedelta
-from collections import deque
-import aiohttp
-from aiohttp import ClientSession
+import httpx
 
 LANG = os.getenv("WIKI_LANG", "ja")
 PROJECT = f"{LANG}.wikipedia"
 WIKI_API = f"https://{LANG}.wikipedia.org/w/api.php"
-REST_SUMMARY = f"https://{LANG}.wikipedia.org/api/rest_v1/page/summary/"
 PAGE_URL_PREFIX = f"https://{LANG}.wikipedia.org/wiki/"
 
 SEARCH_ENGINE_ADD = os.getenv("SEARCH_ADD_ENDPOINT", "https://dev.371tti.net/api/index")
@@ -31,52 +31,93 @@ SUMMARY_MAX = int(os.getenv("SUMMARY_MAX", "800"))
 TOPVIEW_REFRESH = int(os.getenv("TOPVIEW_REFRESH", "3600"))
 
 REQ_INTERVAL = float(os.getenv("REQ_INTERVAL", "0.1"))  # 1秒/リクエスト
+BURST = int(os.getenv("BURST", "5"))  # トークンバケット容量
+INTERNAL_REQ_INTERVAL = float(os.getenv("INTERNAL_REQ_INTERVAL", "0.02"))  # 内部API POST間隔
 
 USER_AGENT = f"WikiUsefulCrawlerAsync/{LANG} 0.1 (+https://example.com; mailto:you@example.com)"
 
+logger = logging.getLogger("wikipedia_crawler")
+
+
+def setup_logging() -> QueueListener:
+    """stdout への書き込みをバックグラウンドスレッドに逃がす。
+
+    print はイベントループ上で stdout ロック + 行毎 flush の同期点になるため、
+    QueueHandler 経由で QueueListener のスレッドに I/O を任せる。
+    """
+    log_queue: queue.Queue = queue.Queue(-1)
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    logger.addHandler(QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener.start()
+    return listener
+
 
 class RateLimiter:
-    def __init__(self, interval: float):
+    """トークンバケット方式: 長期レート 1/interval req/s を維持しつつ
+    burst 個までのバーストを許容する。"""
+
+    def __init__(self, interval: float, burst: int = 1):
         self.interval = interval
-        self._last = 0.0
+        self.rate = (1.0 / interval) if interval > 0 else 0.0
+        self.capacity = max(1.0, float(burst))
+        self._tokens = self.capacity
+        self._last_refill = 0.0
         self._lock = asyncio.Lock()
+        self._loop = None  # 初回 wait 時に実行中 loop をキャッシュ
 
     async def wait(self):
-        async with self._lock:
-            loop_time = asyncio.get_event_loop().time()
-            delta = loop_time - self._last
-            sleep_for = self.interval - delta
-            if sleep_for > 0:
-                await asyncio.sleep(sleep_for)
-            self._last = asyncio.get_event_loop().time()
+        if self.rate <= 0:
+            return
+        # ロック中はトークン計算のみ、sleep はロック解放後に行う
+        # (sleep をロック内で await すると他の待機者まで直列化されてしまう)
+        loop = self._loop
+        if loop is None:
+            loop = self._loop = asyncio.get_running_loop()
+        while True:
+            async with self._lock:
+                now = loop.time()
+                if self._last_refill:
+                    self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1.0:
+                    self._tokens -= 1.0
+                    return
+                sleep_for = (1.0 - self._tokens) / self.rate
+            await asyncio.sleep(sleep_for)
 
 
-rate_limiter = RateLimiter(REQ_INTERVAL)
+rate_limiter = RateLimiter(REQ_INTERVAL, BURST)
+# 内部 API への書き込みは Wikipedia API の礼儀間隔とは別枠で制限する
+internal_limiter = RateLimiter(INTERNAL_REQ_INTERVAL, BURST)
 
 
-async def http_json(session: ClientSession, url: str, params=None, timeout=30):
+async def http_json(session: httpx.AsyncClient, url: str, params=None, timeout=30):
     await rate_limiter.wait()
     try:
-        async with session.get(url, params=params, timeout=timeout) as resp:
-            if resp.status != 200:
-                return None
-            return await resp.json()
+        resp = await session.get(url, params=params, timeout=timeout)
+        if resp.status_code != 200:
+            return None
+        return resp.json()
     except Exception:
         return None
 
 
-async def http_post_json(session: ClientSession, url: str, json_payload: dict, timeout=30):
-    await rate_limiter.wait()
+async def http_post_json(session: httpx.AsyncClient, url: str, json_payload: dict, timeout=30):
+    # POST 先は内部 endpoint (SEARCH_ENGINE_ADD) のみ
+    await internal_limiter.wait()
     try:
-        async with session.post(url, json=json_payload, timeout=timeout) as resp:
-            text = await resp.text()
-            return resp.status, text
+        resp = await session.post(url, json=json_payload, timeout=timeout)
+        return resp.status_code, resp.text
     except Exception as e:
         return 599, str(e)
 
 
-async def get_category_pages(session: ClientSession, category: str, limit: int = 10000):
-    pages = []
+async def get_category_pages(session: httpx.AsyncClient, category: str, limit: int = 10000):
+    """カテゴリ所属記事タイトルを逐次 yield する (limit 到達でページングを打ち切り)。"""
+    yielded = 0
     ccontinue = None
     while True:
         params = {
@@ -91,21 +132,21 @@ async def get_category_pages(session: ClientSession, category: str, limit: int =
             params["cmcontinue"] = ccontinue
         data = await http_json(session, WIKI_API, params=params)
         if not data:
-            break
+            return
         members = data.get("query", {}).get("categorymembers", [])
         for m in members:
             title = m.get("title")
             if title:
-                pages.append(title)
-                if len(pages) >= limit:
-                    return pages
+                yield title
+                yielded += 1
+                if yielded >= limit:
+                    return
         ccontinue = data.get("continue", {}).get("cmcontinue")
         if not ccontinue:
-            break
-    return pages
+            return
 
 
-async def get_random_pages(session: ClientSession, n: int):
+async def get_random_pages(session: httpx.AsyncClient, n: int):
     params = {
         "action": "query",
         "list": "random",
@@ -119,7 +160,7 @@ async def get_random_pages(session: ClientSession, n: int):
     return [r["title"] for r in data.get("query", {}).get("random", []) if r.get("title")]
 
 
-async def get_topview_titles(session: ClientSession):
+async def get_topview_titles(session: httpx.AsyncClient):
     day = (datetime.utcnow() - timedelta(days=1)).strftime("%Y/%m/%d")
     url = f"https://wikimedia.org/api/rest_v1/metrics/pageviews/top/{PROJECT}/all-access/{day}"
     data = await http_json(session, url)
@@ -138,15 +179,41 @@ async def get_topview_titles(session: ClientSession):
     return titles
 
 
-async def fetch_summary(session: ClientSession, title: str):
-    url = REST_SUMMARY + urllib.parse.quote(title, safe="")
-    data = await http_json(session, url)
-    if not data or "extract" not in data:
-        return None
-    return data
+async def fetch_summaries_batch(session: httpx.AsyncClient, titles: list):
+    """extracts API で最大 20 タイトルまとめて要約を取得し {title: extract} を返す。
+
+    REST summary の 1 タイトル 1 リクエストと違い、1 ループ分が 1-2 回の
+    往復で済む (レート制限待ちも同じだけ減る)。
+    """
+    extracts = {}
+    for i in range(0, len(titles), 20):
+        chunk = titles[i:i + 20]
+        params = {
+            "action": "query",
+            "prop": "extracts",
+            "exintro": 1,
+            "explaintext": 1,
+            "exlimit": "max",
+            "redirects": 1,
+            "titles": "|".join(chunk),
+            "format": "json",
+            "formatversion": "2",
+        }
+        data = await http_json(session, WIKI_API, params=params)
+        if not data:
+            continue
+        for page in data.get("query", {}).get("pages", []):
+            title = page.get("title")
+            extract = page.get("extract") or ""
+            if not title or not extract.strip():
+                continue
+            # 全文を持ち回らず取り出し時点で切り詰める
+            # (SUMMARY_MAX=0 は切り詰めなし = descriptions 空で投稿)
+            extracts[title] = extract[:SUMMARY_MAX].strip() if SUMMARY_MAX > 0 else ""
+    return extracts
 
 
-async def post_document(session: ClientSession, url: str, title: str, extract: str):
+async def post_document(session: httpx.AsyncClient, url: str, title: str, extract: str):
     payload = {
         "url": url,
         "title": None,
@@ -156,34 +223,49 @@ async def post_document(session: ClientSession, url: str, title: str, extract: s
     }
     status, text = await http_post_json(session, SEARCH_ENGINE_ADD, payload)
     if status >= 300:
-        print(f"[WARN] add {status} {title[:30]} {text[:60]}")
+        logger.warning(f"[WARN] add {status} {title[:30]} {text[:60]}")
     else:
-        print(f"[OK] {title[:40]}")
+        logger.info(f"[OK] {title[:40]}")
+
 
+def take_cycle(lst: list, idx: int, n: int):
+    """リストをカーソル位置から n 件スライスし (末尾で巡回)、次回カーソルを返す。
 
-def cycle_deque(dq: deque, count: int):
-    out = []
-    for _ in range(min(count, len(dq))):
-        v = dq.popleft()
-        out.append(v)
-        dq.append(v)
-    return out
+    deque の popleft/append を 2n 回呼ぶ代わりにスライス 1-2 回で済む。
+    """
+    if not lst or n <= 0:
+        return [], idx
+    n = min(n, len(lst))
+    out = lst[idx:idx + n]
+    if len(out) < n:
+        out += lst[:n - len(out)]
+    return out, (idx + n) % len(lst)
 
 
 async def main():
-    print(f"[INFO] start async crawler lang={LANG} (1req/{REQ_INTERVAL:.1f}s)")
-
-    async with aiohttp.ClientSession(headers={"User-Agent": USER_AGENT}) as session:
-        print("[INFO] loading categories (時間がかかる可能性あり)")
-        featured_list, good_list = await asyncio.gather(
-            get_category_pages(session, "秀逸な記事"),
-            get_category_pages(session, "良質な記事"),
-        )
+    logger.info(f"[INFO] start async crawler lang={LANG} (1req/{REQ_INTERVAL:.1f}s)")
+
+    # HTTP/2 + keep-alive で wikipedia.org / 内部 endpoint への連続リクエストを多重化
+    async with httpx.AsyncClient(
+        http2=True,
+        headers={"User-Agent": USER_AGENT},
+        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+        follow_redirects=True,
+    ) as session:
+        # batch が 0 のカテゴリは巡回に使われないため取得自体を省く
+        featured_list: list = []
+        good_list: list = []
+        if BATCH_FEATURED > 0 or BATCH_GOOD > 0:
+            logger.info("[INFO] loading categories (時間がかかる可能性あり)")
+            if BATCH_FEATURED > 0:
+                featured_list = [t async for t in get_category_pages(session, "秀逸な記事")]
+            if BATCH_GOOD > 0:
+                good_list = [t async for t in get_category_pages(session, "良質な記事")]
         random.shuffle(featured_list)
         random.shuffle(good_list)
 
-        featured_dq = deque(featured_list)
-        good_dq = deque(good_list)
+        featured_idx = 0
+        good_idx = 0
         topview_cache = []
         topview_time = 0.0
         loop = 0
@@ -200,13 +282,15 @@ async def main():
                     random.shuffle(tv)
                     topview_cache = tv
                     topview_time = now
-                    print(f"[INFO] refresh topview count={len(tv)}")
+                    logger.info(f"[INFO] refresh topview count={len(tv)}")
 
             titles = []
-            if featured_dq:
-                titles += cycle_deque(featured_dq, BATCH_FEATURED)
-            if good_dq:
-                titles += cycle_deque(good_dq, BATCH_GOOD)
+            if featured_list:
+                batch, featured_idx = take_cycle(featured_list, featured_idx, BATCH_FEATURED)
+                titles += batch
+            if good_list:
+                batch, good_idx = take_cycle(good_list, good_idx, BATCH_GOOD)
+                titles += batch
             if topview_cache:
                 take = min(BATCH_TOPVIEW, len(topview_cache))
                 for _ in range(take):
@@ -224,28 +308,33 @@ async def main():
                     seen_local.add(t)
 
             if not uniq:
-                print("[WARN] no titles; sleeping")
+                logger.warning("[WARN] no titles; sleeping")
                 await asyncio.sleep(LOOP_SLEEP)
                 continue
 
-            print(f"[LOOP {loop}] utc={wall_now.isoformat()} process={len(uniq)}")
+            logger.info(f"[LOOP {loop}] utc={wall_now.isoformat()} process={len(uniq)}")
 
             # シリアル処理: summary → add (各2リクエスト → 約2秒/記事)
-            for title in uniq:
-                summary = await fetch_summary(session, title)
-                if not summary:
-                    continue
-                extract = (summary.get("extract") or "").strip()
-                if not extract:
-                    continue
-                page_url = PAGE_URL_PREFIX + urllib.parse.quote(title.replace(" ", "_"))
-                await post_document(session, page_url, summary.get("title") or title, extract[:SUMMARY_MAX])
+            # 要約は extracts API でまとめて取得し、POST のみ並行送信
+            # (実際の発行レートは rate_limiter / internal_limiter が抑える)
+            extracts = await fetch_summaries_batch(session, uniq)
+
+            async def handle(title: str, extract: str):
+                encoded = urllib.parse.quote(title.replace(" ", "_"), safe="")
+                page_url = PAGE_URL_PREFIX + encoded
+                # extract は取得時点で SUMMARY_MAX に切り詰め済み
+                await post_document(session, page_url, title, extract)
+
+            await asyncio.gather(*(handle(t, ex) for t, ex in extracts.items()))
 
             await asyncio.sleep(LOOP_SLEEP)
 
 
 if __name__ == "__main__":
+    listener = setup_logging()
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
-        print("\n[INFO] stopped")
\ No newline at end of file
+        logger.info("[INFO] stopped")
+    finally:
+        listener.stop()
\ No newline at end of file